@@ -1,4 +1,4 @@
-import urllib.request, sys, zipfile
+import urllib.request, sys, zipfile, os
 import xml.etree.ElementTree as etree
 from datetime import datetime
 
@@ -9,19 +9,26 @@ def parseXML():
         tree = etree.parse(xml_fn)
         return tree.getroot()
 
-def generateIndividuals(root):
+def generateIndividuals(root, shell = None):
         
         def generateShell(out_file):
-                with open("cwe_shell.ttl", mode='r', encoding='utf-8') as in_file:
-                        shell = in_file.read()
+                if shell is None:
+                        with open("cwe_shell.ttl", mode='r', encoding='utf-8') as in_file:
+                                out_file.write(in_file.read())
+                else:
                         out_file.write(shell)
                         
         fn = "cwe.ttl"
-        with open(fn, mode='w', encoding='utf-8') as out_file:
-                generateShell(out_file)
-                for item in root.findall(LS + "Attack_Patterns/" + LS + "Attack_Pattern/" + LS + "Related_Weaknesses/" + LS + "Related_Weakness"):
-                        print("CWE-" + item.attrib["CWE_ID"])
-                        out_file.write("\r:" + item.attrib["CWE_ID"] + "\r\trdf:type owl:NamedIndividual;\r\trdf:type :Weakness .")
+        try:
+                with open(fn + ".tmp", mode='w', encoding='utf-8') as out_file:
+                        generateShell(out_file)
+                        for item in root.findall(LS + "Attack_Patterns/" + LS + "Attack_Pattern/" + LS + "Related_Weaknesses/" + LS + "Related_Weakness"):
+                                print("CWE-" + item.attrib["CWE_ID"])
+                                out_file.write("\r:" + item.attrib["CWE_ID"] + "\r\trdf:type owl:NamedIndividual;\r\trdf:type :Weakness .")
+                os.replace(fn + ".tmp", fn)
+        except BaseException:
+                if os.path.exists(fn + ".tmp"): os.remove(fn + ".tmp")
+                raise
 
 def main():
         print("CAPEC/CWE Ontology Generator, Version 2.0")
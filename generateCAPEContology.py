@@ -3,17 +3,48 @@
 The generator downloads the current version of CAPEC List from MITRE site and then generates OWL Manchester syntax ontology.
 The dictionary is downloaded as .zip file and then it is unzipped.
 The ontology is generated with the file name "capec.owl".
+With --watch the generator stays resident, polls the data directory and regenerates the ontology whenever the input or the shell templates change,
+keeping the compiled schema, the shell templates and the already generated individuals in memory between runs.
 """
 
 import urllib.request, re, sys, zipfile, argparse
-import re, os
+import re, os, io, time, hashlib
 import xml.etree.ElementTree as etree
 import lxml.etree
 from datetime import datetime
 from pathlib import Path 
+import generateCAPEC_CWEontology
 
 LS = "{http://capec.mitre.org/capec-3}"
 xml_fn = "data/capec.xml"
+shell_fns = ("shell.ttl", "cwe_shell.ttl")
+
+class Cache:
+        """State kept between regenerations in watch mode."""
+        def __init__(self, incremental = True):
+                self.incremental = incremental
+                self.files = dict()
+                self.items = dict()
+                self.validator = None
+                self.schema_mtime = None
+                self.digest = None
+
+        def readFile(self, fn):
+                mtime = os.stat(fn).st_mtime_ns
+                if fn not in self.files or self.files[fn][0] != mtime:
+                        with open(fn, mode='r', encoding='utf-8') as in_file:
+                                self.files[fn] = (mtime, in_file.read())
+                return self.files[fn][1]
+
+        def isCurrent(self, fn):
+                return fn in self.files and self.files[fn][0] == os.stat(fn).st_mtime_ns
+
+        def getValidator(self, fn):
+                mtime = os.stat(fn).st_mtime_ns
+                if self.validator is None or self.schema_mtime != mtime:
+                        self.validator = lxml.etree.XMLSchema(file=fn)
+                        self.schema_mtime = mtime
+                return self.validator
 
 def code(s):
         return s.replace("\\", "\\\\").replace('"', '\\"')
@@ -504,7 +535,37 @@ def generateViewIndividual(item, root, out_file):
         attackPattern.addContentHistory()
         out_file.write(attackPattern.tostring())
 
-def generateIndividuals(root):
+def renderIndividual(generate, item, *args):
+        extend = Individual.extend
+        Individual.extend = set()
+        try:
+                out_file = io.StringIO()
+                generate(item, *args, out_file)
+                individuals = "".join([i.tostring() for i in Individual.extend])
+        finally:
+                Individual.extend = extend
+        return out_file.getvalue(), individuals
+
+def generateIndividuals(root, cache = None):
+
+        def generateItems(path, tag, generate, *args, cached = True):
+                regenerated = 0
+                reused = 0
+                items = root.find(LS + path)
+                for item in items.findall(LS + tag):
+                        key = (tag, item.attrib["ID"])
+                        digest = hashlib.sha1(etree.tostring(item)).digest() if cache.incremental else None
+                        if cached and key in cache.items and cache.items[key][0] == digest:
+                                text, ind = cache.items[key][1:]
+                                reused += 1
+                        else:
+                                print("CAPEC-" + item.attrib["ID"])
+                                text, ind = renderIndividual(generate, item, *args)
+                                regenerated += 1
+                        if cache.incremental: items_cache[key] = (digest, text, ind)
+                        out_file.write(text)
+                        individuals.append(ind)
+                return regenerated, reused
 
         def generateShell():
                 def collectExternalReferences():
@@ -536,19 +597,18 @@ def generateIndividuals(root):
                                         r += '" ;\n'
                                 return r
 
-                with open("shell.ttl", mode='r', encoding='utf-8') as in_file:
-                        shell = in_file.read()
-                        name = root.attrib["Name"]
-                        name = "" if name is None else name
-                        shell = shell.replace("NAME", name)
-                        version = root.attrib["Version"]
-                        version = "" if version is None else version
-                        shell = shell.replace("VERSION", version)
-                        date = root.attrib["Date"]
-                        date = "" if date is None else date
-                        shell = shell.replace("DATE", date)
-                        shell = shell.replace(':External_Reference " ;\n', collectExternalReferences())
-                        out_file.write(shell)                                                       
+                shell = cache.readFile("shell.ttl")
+                name = root.attrib["Name"]
+                name = "" if name is None else name
+                shell = shell.replace("NAME", name)
+                version = root.attrib["Version"]
+                version = "" if version is None else version
+                shell = shell.replace("VERSION", version)
+                date = root.attrib["Date"]
+                date = "" if date is None else date
+                shell = shell.replace("DATE", date)
+                shell = shell.replace(':External_Reference " ;\n', collectExternalReferences())
+                out_file.write(shell)                                                       
                 out_file.write("\n")
                 
         print("Processing started")
@@ -559,50 +619,137 @@ def generateIndividuals(root):
         except FileExistsError as exc:
                 print(exc)
        
+        if cache is None: cache = Cache(incremental = False)
+        items_cache = dict()
+        individuals = []
+        counts = []
         fn = "results/capec.ttl"
-        with open(fn, mode='w', encoding='utf-8') as out_file:
-                
-                generateShell()
-
-                print("Generate attack patterns")
-                attackPatterns = root.find(LS + "Attack_Patterns")
-                for item in attackPatterns.findall(LS + "Attack_Pattern"):
-                        print("CAPEC-" + item.attrib["ID"])
-                        generateAttackPatternIndividual(item, out_file)
-
-                print("Generate categories")
-                categories = root.find(LS + "Categories")
-                for item in categories.findall(LS + "Category"):
-                        print("CAPEC-" + item.attrib["ID"])
-                        generateCategoryIndividual(item, out_file)
-
-                print("Generate views")
-                views = root.find(LS + "Views")
-                for item in views.findall(LS + "View"):
-                        print("CAPEC-" + item.attrib["ID"])
-                        generateViewIndividual(item, root, out_file)
+        try:
+                with open(fn + ".tmp", mode='w', encoding='utf-8') as out_file:
                         
-                for i in Individual.extend:
-                        out_file.write(i.tostring())
+                        generateShell()
+
+                        print("Generate attack patterns")
+                        counts.append(generateItems("Attack_Patterns", "Attack_Pattern", generateAttackPatternIndividual))
+
+                        print("Generate categories")
+                        counts.append(generateItems("Categories", "Category", generateCategoryIndividual))
+
+                        print("Generate views")
+                        # View filters select members from the whole catalog, so views are always regenerated.
+                        counts.append(generateItems("Views", "View", generateViewIndividual, root, cached = False))
+                                
+                        for i in individuals:
+                                out_file.write(i)
+                os.replace(fn + ".tmp", fn)
+        except BaseException:
+                if os.path.exists(fn + ".tmp"): os.remove(fn + ".tmp")
+                raise
+        cache.items = items_cache
+        regenerated = sum([c[0] for c in counts])
+        reused = sum([c[1] for c in counts])
+        print(f"Regenerated: {regenerated}, reused: {reused}")
         print("Processing finished")
+        return regenerated, reused
 
-def main(download):
+def generate(cache, cwe = False):
+        with open(xml_fn, mode='rb') as in_file:
+                contents = in_file.read()
+        xml_validator = cache.getValidator("data/ap_schema_v3.5.xsd")
+        if not xml_validator.validate(lxml.etree.fromstring(contents, base_url=xml_fn)):
+                print("CAPEC List contents is not valid!")
+                print(xml_validator.error_log)
+                return None
+        root = etree.fromstring(contents)
+        counts = generateIndividuals(root, cache)
+        if cwe:
+                generateCAPEC_CWEontology.generateIndividuals(root, cache.readFile("cwe_shell.ttl"))
+        return counts
+
+def snapshot(path, files = ()):
+        r = dict()
+        with os.scandir(path) as it:
+                for e in it:
+                        if e.is_file() and not e.name.endswith(".tmp"):
+                                try:
+                                        st = e.stat()
+                                except FileNotFoundError:
+                                        continue
+                                r[e.name] = (st.st_mtime_ns, st.st_size)
+        for fn in files:
+                try:
+                        st = os.stat(fn)
+                except FileNotFoundError:
+                        continue
+                r[fn] = (st.st_mtime_ns, st.st_size)
+        return r
+
+def currentMemory():
+        try:
+                with open("/proc/self/statm", mode='r') as in_file:
+                        pages = int(in_file.read().split()[1])
+        except OSError:
+                return "n/a"
+        return f"{pages * os.sysconf('SC_PAGE_SIZE') / 2**20:.1f}"
+
+def regenerate(cache, log_fn):
+        start = datetime.now()
+        counts = (0, 0)
+        try:
+                with open(xml_fn, mode='rb') as in_file:
+                        digest = hashlib.sha1(in_file.read()).digest()
+                if digest == cache.digest and cache.schema_mtime == os.stat("data/ap_schema_v3.5.xsd").st_mtime_ns and all([cache.isCurrent(fn) for fn in shell_fns]): return
+                print(start)
+                r = generate(cache, cwe = True)
+                if r is None:
+                        status = "invalid"
+                        cache.digest = None
+                else:
+                        status = "ok"
+                        counts = r
+                        cache.digest = digest
+        except Exception as exc:
+                print(f"{type(exc).__name__}: {exc}")
+                status = "error"
+                # A failed run may have refreshed the cached templates without writing them out, so force the next change to regenerate.
+                cache.digest = None
+        end = datetime.now()
+        rss = currentMemory()
+        print(f"Regeneration {status}, elapsed: {end - start}, current RSS: {rss} MB")
+        Path("results").mkdir(exist_ok=True)
+        new_log = not os.path.exists(log_fn)
+        with open(log_fn, mode='a', encoding='utf-8') as log_file:
+                if new_log: log_file.write("time\tstatus\telapsed_s\trss_mb\tregenerated\treused\n")
+                log_file.write(f"{end.isoformat()}\t{status}\t{(end - start).total_seconds():.3f}\t{rss}\t{counts[0]}\t{counts[1]}\n")
+
+def watch(interval):
+        cache = Cache()
+        state = None
+        print(f"Watching data and shell templates for changes every {interval} s")
+        while True:
+                try:
+                        current = snapshot("data", shell_fns)
+                        if current != state:
+                                # Wait until the files stop changing so a partially written input is not picked up.
+                                time.sleep(interval)
+                                if snapshot("data", shell_fns) == current:
+                                        state = current
+                                        regenerate(cache, "results/watch.log")
+                except Exception as exc:
+                        print(f"{type(exc).__name__}: {exc}")
+                time.sleep(interval)
+
+def main(download, watch_interval = None):
         print("CAPEC Ontology Generator, Version 7.1")
         start = datetime.now()
         print(start)
         if download:
                 print("Download CAPEC List")
                 downloadCAPEC()
-        xml_file = lxml.etree.parse("data/capec.xml")
-        xml_validator = lxml.etree.XMLSchema(file="data/ap_schema_v3.5.xsd")
-        if not xml_validator.validate(xml_file):
-                print("CAPEC List contents is not valid!")
-                print(xml_validator.error_log)
+        if watch_interval is not None:
+                watch(watch_interval)
                 return
-        xml_file = None
-        xml_validator = None
-        root = parseXML()
-        generateIndividuals(root)
+        if generate(Cache(incremental = False)) is None: return
         print("Generation end")
         end = datetime.now()
         print(end)
@@ -611,5 +758,14 @@ def main(download):
 if __name__ == "__main__":
         parser = argparse.ArgumentParser()
         parser.add_argument('-d', '--download', action="store_true", help='download input from the Web')
+        parser.add_argument('-w', '--watch', action="store_true", help='keep running and regenerate the ontology when files in data or the shell templates change')
+        parser.add_argument('-i', '--interval', type=float, help='polling interval in seconds for --watch (default: 2)')
         args = parser.parse_args()
-        main(args.download)
+        if args.interval is not None and not args.watch:
+                parser.error("--interval requires --watch")
+        if args.interval is not None and args.interval <= 0:
+                parser.error("--interval must be positive")
+        try:
+                main(args.download, (2.0 if args.interval is None else args.interval) if args.watch else None)
+        except KeyboardInterrupt:
+                pass